@@ -1,15 +1,133 @@
 from flask import Flask, render_template, request, send_file, jsonify
 import pandas as pd
+import matplotlib
+matplotlib.use('Agg')  # Backend sin interfaz gráfica; debe fijarse antes de importar pyplot
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.font_manager import FontProperties
+import numpy as np
+import atexit
+import hashlib
 import io
+import json
 import os
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from PyPDF2 import PdfMerger
 
 app = Flask(__name__)
 
+ORDER = ['N330QT', 'N331QT', 'N332QT', 'N334QT', 'N335QT', 'N336QT', 'N337QT']
+DAY_WINDOW = pd.Timedelta(hours=27) - pd.Timedelta(minutes=1)  # Ventana de cada página
+NS_PER_HOUR = 3600 * 10**9
+NS_PER_DAY = 24 * NS_PER_HOUR
+
+plt.rcParams['path.simplify'] = True
+plt.rcParams['path.simplify_threshold'] = 1.0
+plt.rcParams['pdf.compression'] = 9
+
+def build_figure():
+    # Esqueleto de la figura: se construye una sola vez y se reutiliza en cada petición
+    fig, ax = plt.subplots(figsize=(11, 8.5))  # Tamaño carta horizontal
+    # Funciones del Axes que este gráfico no usa: los límites se fijan a mano
+    ax.set_autoscale_on(False)
+    ax.grid(False)
+    ax.minorticks_off()
+    for spine in ax.spines.values():
+        spine.set_visible(False)
+    ax.xaxis_date()
+    ax.set_yticks(range(len(ORDER)))
+    ax.set_yticklabels(reversed(ORDER))
+    ax.set_ylim(-1, len(ORDER))
+    ax.xaxis.set_major_locator(mdates.HourLocator(interval=1))
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
+    ax.tick_params(axis='x', labelrotation=45, labelsize=10)
+    fig.subplots_adjust(left=0.09, right=0.95, top=0.93, bottom=0.15)  # Márgenes fijos para etiquetas y título
+    ax.set_xlabel('Hora')
+    ax.set_ylabel('Aeronave')
+    return fig, ax
+
+def measure_hours_per_pixel(ax, renderer):
+    # Horas del eje x que ocupa un píxel, medido una sola vez
+    return (DAY_WINDOW / pd.Timedelta(hours=1)) / ax.get_window_extent(renderer).width
+
+fig, ax = build_figure()
+renderer = fig.canvas.get_renderer()
+HOURS_PER_PIXEL = measure_hours_per_pixel(ax, renderer)
+
+@lru_cache(maxsize=4096)
+def text_width_hours(text, fontsize=8):
+    # Ancho real del texto en horas según las métricas de la fuente; los códigos se repiten mucho
+    width_px, _, _ = renderer.get_text_width_height_descent(text, FontProperties(size=fontsize), ismath=False)
+    return width_px * HOURS_PER_PIXEL
+
+def truncate_text(text, max_hours):
+    # Prefijo más largo que, con '...', cabe en max_hours; nunca más ancho que el original.
+    # El ancho crece con el prefijo, así que se busca por bisección
+    text_width = text_width_hours(text)
+
+    def fits(k):
+        width = text_width_hours(text[:k] + '...')
+        return width <= max_hours and width < text_width
+
+    lo, hi = 0, len(text) - 1  # fits(lo) se da por cierto; se busca el mayor k que cabe
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if fits(mid):
+            lo = mid
+        else:
+            hi = mid - 1
+    if lo > 0:
+        return text[:lo] + '...'
+    # Ni un carácter cabe: solo se indica que hay texto
+    return '...' if text_width_hours('...') < text_width else text
+
+plot_lock = threading.Lock()  # pyplot no es thread-safe
+plot_executor = None
+MIN_DAYS_PER_WORKER = 4  # Días por proceso a partir de los cuales compensa usar el pool
+executor_lock = threading.Lock()
+PDF_CACHE_SIZE = 128
+pdf_cache = OrderedDict()  # hash de la petición -> bytes del PDF, en orden LRU
+pdf_cache_lock = threading.Lock()
+
+def get_plot_executor():
+    # Pool de procesos para renderizar los días en paralelo; se crea una sola vez.
+    # 'spawn' porque matplotlib no es seguro tras un fork (macOS)
+    global plot_executor
+    with executor_lock:
+        if plot_executor is None:
+            plot_executor = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=mp.get_context('spawn'))
+        return plot_executor
+
+def discard_plot_executor(executor):
+    # Un pool roto (p. ej. un proceso terminado por falta de memoria) no se recupera: se descarta
+    global plot_executor
+    with executor_lock:
+        if plot_executor is executor:
+            plot_executor = None
+    executor.shutdown(wait=False)
+
+def shutdown_plot_executor():
+    with executor_lock:
+        executor = plot_executor
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+atexit.register(shutdown_plot_executor)
+
+NUMERIC_DATE = re.compile(r'^\d{2}/\d{2}/\d{4}')
+
 def parse_dates(date_series):
     formats = ['%d/%m/%Y %H:%M', '%d%b %H:%M']
+    sample = date_series.dropna()
+    if not sample.empty and not NUMERIC_DATE.match(str(sample.iloc[0]).strip()):
+        formats.reverse()  # Probar primero el formato que coincide con el primer valor
     for fmt in formats:
         try:
             return pd.to_datetime(date_series, format=fmt, dayfirst=True)
@@ -17,69 +135,95 @@ def parse_dates(date_series):
             continue
     raise ValueError("Date conversion error: None of the formats matched.")
 
-def text_fits(ax, text, start, duration):
-    text_length_approx = len(text) * 0.02
-    return duration.total_seconds() / 3600 >= text_length_approx
+def rank_aircraft(df):
+    # Posición de cada matrícula en ORDER; las que no están en la lista se descartan
+    rank_by_reg = {reg: r for r, reg in enumerate(ORDER)}
+    ranks = df['Reg.'].map(rank_by_reg)
+    return df[ranks.notna()].assign(_rank=ranks.dropna().astype('int8'))
+
+def text_widths(texts):
+    return np.fromiter((text_width_hours(text) for text in texts), dtype=float, count=len(texts))
+
+def layout_flights(bar_starts, durations, texts):
+    # Geometría de todos los vuelos de una aeronave, calculada en bloque con numpy.
+    # Entradas en nanosegundos (int64); salida en coordenadas de matplotlib (días)
+    hours = durations / NS_PER_HOUR
+    x_starts = mdates.date2num(bar_starts.view('datetime64[ns]'))
+    widths = durations / NS_PER_DAY
+    centers = x_starts + widths / 2
+    x_ends = x_starts + widths
+    max_hours = hours * 0.8  # Limitar el ancho del texto a 80% de la duración
+    fits = {name: hours >= text_widths(column) for name, column in texts.items()}
+    return x_starts, widths, centers, x_ends, max_hours, fits
 
-def draw_text(ax, text, x, y, duration, align='center', **kwargs):
-    max_width = duration.total_seconds() / 3600 * 0.8  # Limitar el ancho del texto a 80% de la duración
-    if text_fits(ax, text, x, duration):
-        ax.text(x + duration / 2, y, text, ha=align, va='center', **kwargs)
+def draw_text(ax, artists, text, x, y, fits, max_hours, align='center', **kwargs):
+    if not text or text.isspace():
+        return  # Un campo vacío no necesita su propio Text
+    if fits:
+        artists.append(ax.text(x, y, text, ha=align, va='center', **kwargs))
     else:
-        truncated_text = text[:int(max_width * 50)] + '...'  # Ajustar longitud del texto basado en duración
-        ax.text(x + duration / 2, y, truncated_text, ha=align, va='center', **kwargs)
+        truncated_text = truncate_text(text, max_hours)  # Ajustar longitud del texto basado en duración
+        artists.append(ax.text(x, y, truncated_text, ha=align, va='center', **kwargs))
 
-def generate_plot(df, additional_text, start_time, end_time):
-    order = ['N330QT', 'N331QT', 'N332QT', 'N334QT', 'N335QT', 'N336QT', 'N337QT']
-    df['aeronave'] = pd.Categorical(df['Reg.'], categories=order, ordered=True)
-    df = df.sort_values('aeronave', ascending=False)
-    fig, ax = plt.subplots(figsize=(11, 8.5))  # Tamaño carta horizontal
+def plot_flights(ax, df, start_time, end_time, artists):
+    start_time = start_time.value  # ns
+    end_time = end_time.value
+    grouped = dict(iter(df.groupby('_rank', sort=False, observed=True)))
 
-    for i, aeronave in enumerate(reversed(order)):
-        vuelos_aeronave = df[df['aeronave'] == aeronave]
-        for _, vuelo in vuelos_aeronave.iterrows():
-            start = vuelo['fecha_salida']
-            duration = vuelo['fecha_llegada'] - vuelo['fecha_salida']
-            if start < start_time:
-                duration -= (start_time - start)
-                start = start_time
-            if start + duration > end_time:
-                duration = end_time - start
-            rect_height = 0.2
-            ax.broken_barh([(start, duration)], (i - rect_height/2, rect_height), facecolors='#ADD8E6')  # Azul claro
-            
-            draw_text(ax, vuelo['Flight'], start, i, duration, color='black', fontsize=8)
-            draw_text(ax, vuelo['Trip'], start, i + 0.3, duration, color='blue', fontsize=8)  # Bajado ligeramente
-            draw_text(ax, vuelo['Notas'], start, i - 0.25, duration, color='green', fontsize=8)
-            draw_text(ax, vuelo['Tripadi'], start, i - 0.4, duration, color='purple', fontsize=8)  # Subido ligeramente
-
-            if text_fits(ax, vuelo['From'], start, duration):
-                ax.text(start, i + 0.2, vuelo['From'], ha='left', va='center', color='black', fontsize=8)
-            if text_fits(ax, vuelo['To'], start, duration):
-                ax.text(start + duration, i + 0.2, vuelo['To'], ha='right', va='center', color='black', fontsize=8)
+    for r in range(len(ORDER) - 1, -1, -1):
+        vuelos_aeronave = grouped.get(r)
+        if vuelos_aeronave is None:
+            continue
+        i = len(ORDER) - 1 - r  # La primera aeronave de la lista queda arriba
+        # Columnas como arreglos numpy para no construir una Series por fila
+        starts = vuelos_aeronave['_sal'].to_numpy()
+        ends = vuelos_aeronave['_lle'].to_numpy()
+        # Recortar las barras a la ventana del día
+        bar_starts = np.maximum(starts, start_time)
+        durations = np.minimum(ends, end_time) - bar_starts
+        texts = {col: vuelos_aeronave[col].to_numpy() for col in ('Flight', 'Trip', 'Notas', 'Tripadi', 'From', 'To')}
+        x_starts, widths, centers, x_ends, max_hours, fits = layout_flights(bar_starts, durations, texts)
+        departures = vuelos_aeronave['_hsal'].to_numpy()
+        arrivals = vuelos_aeronave['_hlle'].to_numpy()
+        rect_height = 0.2
+        bars = list(zip(x_starts, widths))
+        artists.append(ax.broken_barh(bars, (i - rect_height/2, rect_height), facecolors='#ADD8E6'))  # Azul claro
+
+        # Solo se emiten los textos; las coordenadas ya están calculadas
+        for j, (salida, llegada, start, end, center) in enumerate(zip(departures, arrivals, x_starts, x_ends, centers)):
+            max_width = max_hours[j]
+            draw_text(ax, artists, texts['Flight'][j], center, i, fits['Flight'][j], max_width, color='black', fontsize=8)
+            draw_text(ax, artists, texts['Trip'][j], center, i + 0.3, fits['Trip'][j], max_width, color='blue', fontsize=8)  # Bajado ligeramente
+            draw_text(ax, artists, texts['Notas'][j], center, i - 0.25, fits['Notas'][j], max_width, color='green', fontsize=8)
+            draw_text(ax, artists, texts['Tripadi'][j], center, i - 0.4, fits['Tripadi'][j], max_width, color='purple', fontsize=8)  # Subido ligeramente
+
+            if fits['From'][j]:
+                artists.append(ax.text(start, i + 0.2, texts['From'][j], ha='left', va='center', color='black', fontsize=8))
+            if fits['To'][j]:
+                artists.append(ax.text(end, i + 0.2, texts['To'][j], ha='right', va='center', color='black', fontsize=8))
             
-            ax.text(start, i - 0.2, vuelo['fecha_salida'].strftime('%H:%M'), ha='left', va='center', color='black', fontsize=6)
-            ax.text(start + duration, i - 0.2, vuelo['fecha_llegada'].strftime('%H:%M'), ha='right', va='center', color='black', fontsize=6)
+            artists.append(ax.text(start, i - 0.2, salida, ha='left', va='center', color='black', fontsize=6))
+            artists.append(ax.text(end, i - 0.2, llegada, ha='right', va='center', color='black', fontsize=6))
 
-    ax.set_yticks(range(len(order)))
-    ax.set_yticklabels(reversed(order))
-    ax.set_ylim(-1, len(order))
-    ax.xaxis.set_major_locator(mdates.HourLocator(interval=1))
-    ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
-    plt.xticks(rotation=45, fontsize=10)
-    
-    ax.set_xlim(start_time, end_time)
-    
-    plt.subplots_adjust(left=0.05, right=0.95, top=0.95, bottom=0.15)
-    plt.xlabel('Hora')
-    plt.ylabel('Aeronave')
-    plt.title(f'Programación de Vuelos QT {additional_text}')
+def generate_plot(fig, ax, pdf, df, additional_text, start_time, end_time):
+    artists = []  # Artistas dinámicos de esta petición, se retiran tras guardar
+    try:
+        plot_flights(ax, df, start_time, end_time, artists)
+        ax.set_xlim(start_time, end_time)
+        ax.set_title(f'Programación de Vuelos QT {additional_text}')
+        pdf.savefig(fig)
+    finally:
+        for artist in artists:
+            artist.remove()
 
+def generate_pdf_worker(tasks):
+    # Renderiza una serie de días consecutivos en un solo PDF, una página por día.
+    # En un proceso hijo usa la figura en caché de ese proceso
     buf = io.BytesIO()
-    plt.savefig(buf, format='pdf', bbox_inches='tight')
-    buf.seek(0)
-    plt.close(fig)
-    return buf
+    with plot_lock, PdfPages(buf) as pdf:
+        for df, additional_text, start_time, end_time in tasks:
+            generate_plot(fig, ax, pdf, df, additional_text, start_time, end_time)
+    return buf.getvalue()
 
 def process_and_plot(df, additional_text):
     try:
@@ -90,48 +234,105 @@ def process_and_plot(df, additional_text):
     except ValueError as e:
         return None, f"Date conversion error: {e}"
 
+    # Sin STD el vuelo no cae en ningún día y se omite; sin STA, NaT se convertiría en el
+    # mínimo de int64 y desbordaría la aritmética de las barras
+    df = rank_aircraft(df)
+    df = df[df['fecha_salida'].notna()].copy()
+    if df.empty:
+        return None, "No flights found for the listed aircraft."
+    missing = df['fecha_llegada'].isna()
+    if missing.any():
+        flights = ', '.join(str(flight) for flight in df.loc[missing, 'Flight'])
+        return None, f"Missing STA for flight(s): {flights}"
+
     df['Trip'] = df['Trip'].fillna(' ')
     df['Notas'] = df['Notas'].fillna(' ')
     df['Tripadi'] = df['Tripadi'].fillna(' ')
+    # Fechas como enteros en nanosegundos para operar con numpy sin Timestamps
+    df['_sal'] = df['fecha_salida'].to_numpy(dtype='datetime64[ns]').view('int64')
+    df['_lle'] = df['fecha_llegada'].to_numpy(dtype='datetime64[ns]').view('int64')
+    # Horas de salida y llegada ya formateadas, en una sola pasada por columna
+    df['_hsal'] = df['fecha_salida'].dt.strftime('%H:%M')
+    df['_hlle'] = df['fecha_llegada'].dt.strftime('%H:%M')
 
-    pdf_buffers = []
+    tasks = []
     current_date = df['fecha_salida'].min().normalize()
     end_of_data = df['fecha_llegada'].max()
+    # Ordenado por salida, cada día es un rango contiguo que se ubica con búsqueda binaria
+    df = df.sort_values('fecha_salida', kind='stable', na_position='last')
+    times = df['fecha_salida'].to_numpy()
 
     while current_date <= end_of_data:
         current_start_time = current_date + pd.Timedelta(hours=5)
-        current_end_time = current_start_time + pd.Timedelta(hours=27) - pd.Timedelta(minutes=1)
-        df_period = df[(df['fecha_salida'] >= current_start_time) & (df['fecha_salida'] < current_end_time)]
+        current_end_time = current_start_time + DAY_WINDOW
+        lo = times.searchsorted(current_start_time.to_datetime64(), side='left')
+        hi = times.searchsorted(current_end_time.to_datetime64(), side='left')
+        df_period = df.iloc[lo:hi]
         if not df_period.empty:
-            buf = generate_plot(df_period, additional_text, current_start_time, current_end_time)
-            pdf_buffers.append(buf)
+            tasks.append((df_period, additional_text, current_start_time, current_end_time))
         current_date += pd.Timedelta(days=1)
 
-    return pdf_buffers, None
+    if not tasks:
+        return None, "No flights found for the listed aircraft."
+
+    # Los días son independientes: se reparten en tramos consecutivos, uno por proceso.
+    # Arrancar procesos cuesta más que unos pocos días, así que con poco trabajo se renderiza aquí
+    n_chunks = min(len(tasks) // MIN_DAYS_PER_WORKER, os.cpu_count() or 1)
+    if n_chunks <= 1:
+        return generate_pdf_worker(tasks), None
+    chunks = [tasks[k * len(tasks) // n_chunks:(k + 1) * len(tasks) // n_chunks] for k in range(n_chunks)]
+    executor = get_plot_executor()
+    try:
+        results = list(executor.map(generate_pdf_worker, chunks))
+    except BrokenProcessPool:
+        discard_plot_executor(executor)
+        return generate_pdf_worker(tasks), None
+    output = io.BytesIO()
+    merger = PdfMerger()
+    for data in results:
+        merger.append(io.BytesIO(data))
+    merger.write(output)
+    merger.close()
+    return output.getvalue(), None
+
+def render_pdf(table_data, additional_text):
+    try:
+        rows = json.loads(table_data)  # Registros de la tabla; sin la inferencia de tipos de read_json
+        df = pd.DataFrame.from_records(rows)
+    except (ValueError, TypeError) as e:
+        return None, f"JSON parsing error: {e}"
+
+    return process_and_plot(df, additional_text)
+
+def render_pdf_cached(table_data, additional_text):
+    # Una petición idéntica (reintento, recarga) devuelve el PDF ya generado
+    key = hashlib.blake2b(json.dumps([table_data, additional_text]).encode(), digest_size=16).hexdigest()
+    with pdf_cache_lock:
+        if key in pdf_cache:
+            pdf_cache.move_to_end(key)
+            return pdf_cache[key], None
+
+    pdf, error = render_pdf(table_data, additional_text)
+    if error:
+        return None, error
+
+    with pdf_cache_lock:
+        pdf_cache[key] = pdf
+        if len(pdf_cache) > PDF_CACHE_SIZE:
+            pdf_cache.popitem(last=False)
+    return pdf, None
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
         table_data = request.form['table_data']
         additional_text = request.form.get('additional_text')
-        try:
-            df = pd.read_json(table_data)
-        except ValueError as e:
-            return jsonify({'error': f"JSON parsing error: {e}"}), 400
 
-        pdf_buffers, error = process_and_plot(df, additional_text)
+        pdf, error = render_pdf_cached(table_data, additional_text)
         if error:
             return jsonify({'error': error}), 400
         
-        output = io.BytesIO()
-        merger = PdfMerger()
-        for buf in pdf_buffers:
-            merger.append(buf)
-        merger.write(output)
-        merger.close()
-        output.seek(0)
-        
-        return send_file(output, as_attachment=True, download_name='programacion_vuelos_qt.pdf', mimetype='application/pdf')
+        return send_file(io.BytesIO(pdf), as_attachment=True, download_name='programacion_vuelos_qt.pdf', mimetype='application/pdf')
     return render_template('index.html')
 
 if __name__ == '__main__':
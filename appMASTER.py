@@ -1,7 +1,10 @@
 from flask import Flask, render_template, request, send_file, jsonify
 import pandas as pd
+import matplotlib
+matplotlib.use('Agg')  # Backend sin interfaz gráfica; debe fijarse antes de importar pyplot
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
+import numpy as np
 import io
 import os
 
@@ -18,7 +21,7 @@ def parse_dates(date_series):
 
 def text_fits(ax, text, start, duration):
     text_length_approx = len(text) * 0.02
-    return duration.total_seconds() / 3600 >= text_length_approx
+    return duration / np.timedelta64(1, 'h') >= text_length_approx
 
 def process_and_plot(df, additional_text):
     try:
@@ -30,22 +33,35 @@ def process_and_plot(df, additional_text):
         return None, f"Date conversion error: {e}"
 
     order = ['N330QT', 'N331QT', 'N332QT', 'N334QT', 'N335QT', 'N336QT', 'N337QT']
-    df['aeronave'] = pd.Categorical(df['Reg.'], categories=order, ordered=True)
-    df = df.sort_values('aeronave', ascending=False)
+    rank_by_reg = {reg: r for r, reg in enumerate(order)}
+    df['_rank'] = df['Reg.'].map(rank_by_reg)
+    vuelos = df[df['_rank'].notna()].astype({'_rank': 'int8'})
+    grouped = dict(iter(vuelos.groupby('_rank', sort=False, observed=True)))
     fig, ax = plt.subplots(figsize=(20, 10))
 
-    for i, aeronave in enumerate(reversed(order)):
-        vuelos_aeronave = df[df['aeronave'] == aeronave]
-        for _, vuelo in vuelos_aeronave.iterrows():
-            start = vuelo['fecha_salida']
-            duration = vuelo['fecha_llegada'] - vuelo['fecha_salida']
-            rect_height = 0.2
-            ax.broken_barh([(start, duration)], (i - rect_height/2, rect_height), facecolors='red')
-            flight_text = vuelo['Flight']
-            trip_text = vuelo['Trip']
-            notas_text = vuelo['Notas']
-            tripadi_text = vuelo['Tripadi']
-            
+    for r in range(len(order) - 1, -1, -1):
+        vuelos_aeronave = grouped.get(r)
+        if vuelos_aeronave is None:
+            continue
+        i = len(order) - 1 - r  # La primera aeronave de la lista queda arriba
+        # Columnas como arreglos numpy para no construir una Series por fila
+        starts = vuelos_aeronave['fecha_salida'].to_numpy()
+        ends = vuelos_aeronave['fecha_llegada'].to_numpy()
+        durations = ends - starts
+        flights = vuelos_aeronave['Flight'].to_numpy()
+        trips = vuelos_aeronave['Trip'].to_numpy()
+        notas = vuelos_aeronave['Notas'].to_numpy()
+        tripadis = vuelos_aeronave['Tripadi'].to_numpy()
+        origins = vuelos_aeronave['From'].to_numpy()
+        destinations = vuelos_aeronave['To'].to_numpy()
+        # Horas ya formateadas, en una sola pasada por columna
+        departures = vuelos_aeronave['fecha_salida'].dt.strftime('%H:%M').to_numpy()
+        arrivals = vuelos_aeronave['fecha_llegada'].dt.strftime('%H:%M').to_numpy()
+        rect_height = 0.2
+        ax.broken_barh(list(zip(starts, durations)), (i - rect_height/2, rect_height), facecolors='red')
+
+        for start, end, duration, flight_text, trip_text, notas_text, tripadi_text, origin_text, destination_text, salida, llegada in zip(
+                starts, ends, durations, flights, trips, notas, tripadis, origins, destinations, departures, arrivals):
             if text_fits(ax, flight_text, start, duration):
                 ax.text(start + duration / 2, i, flight_text, ha='center', va='center', color='black', fontsize=8)
             else:
@@ -60,18 +76,16 @@ def process_and_plot(df, additional_text):
             # Tripadi text below the Notas
             ax.text(start + duration / 2, i - 0.45, tripadi_text, ha='center', va='top', color='purple', fontsize=8)
 
-            origin_text = vuelo['From']
             if text_fits(ax, origin_text, start, duration):
                 ax.text(start, i + 0.2, origin_text, ha='left', va='center', color='black', fontsize=8)
             else:
                 ax.text(start, i - rect_height, origin_text, ha='left', va='top', color='black', fontsize=8)
-            destination_text = vuelo['To']
             if text_fits(ax, destination_text, start, duration):
                 ax.text(start + duration, i + 0.2, destination_text, ha='right', va='center', color='black', fontsize=8)
             else:
                 ax.text(start + duration, i - rect_height, destination_text, ha='right', va='top', color='black', fontsize=8)
-            ax.text(start, i - 0.2, vuelo['fecha_salida'].strftime('%H:%M'), ha='left', va='center', color='black', fontsize=6)
-            ax.text(start + duration, i - 0.2, vuelo['fecha_llegada'].strftime('%H:%M'), ha='right', va='center', color='black', fontsize=6)
+            ax.text(start, i - 0.2, salida, ha='left', va='center', color='black', fontsize=6)
+            ax.text(end, i - 0.2, llegada, ha='right', va='center', color='black', fontsize=6)
 
     ax.set_yticks(range(len(order)))
     ax.set_yticklabels(reversed(order))